@@ -1,4 +1,5 @@
 import asyncio
+import logging
 import sys
 
 
@@ -15,6 +16,10 @@ from aact.messages import DataModel
 T_agent_observation = TypeVar("T_agent_observation", bound=DataModel)
 T_agent_action = TypeVar("T_agent_action", bound=DataModel)
 
+MAX_PENDING_PUBLISHES = 256
+
+log = logging.getLogger("base_agent")
+
 
 class BaseAgent(Node[T_agent_observation, T_agent_action]):
     def __init__(
@@ -29,9 +34,14 @@ class BaseAgent(Node[T_agent_observation, T_agent_action]):
             redis_url=redis_url,
         )
 
+        self.output_channels: tuple[tuple[str, type[T_agent_action]], ...] = tuple(
+            self.output_channel_types.items()
+        )
         self.observation_queue: asyncio.Queue[T_agent_observation] = asyncio.Queue()
         self.task_scheduler: asyncio.Task[None] | None = None
         self.shutdown_event: asyncio.Event = asyncio.Event()
+        self._pending_publishes: list[tuple[str, str]] = []
+        self._flush_task: asyncio.Task[None] | None = None
 
     async def __aenter__(self) -> Self:
         self.task_scheduler = asyncio.create_task(self._task_scheduler())
@@ -41,6 +51,14 @@ class BaseAgent(Node[T_agent_observation, T_agent_action]):
         self.shutdown_event.set()
         if self.task_scheduler is not None:
             self.task_scheduler.cancel()
+        # Deliver anything still queued before the connection is closed.
+        if self._flush_task is not None:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        try:
+            await self._flush_publishes()
+        except Exception:
+            # still unsubscribe and close the connection below
+            log.exception("Failed to publish messages during shutdown")
         return await super().__aexit__(exc_type, exc_value, traceback)
 
     async def aact(self, observation: T_agent_observation) -> T_agent_action | None:
@@ -56,11 +74,40 @@ class BaseAgent(Node[T_agent_observation, T_agent_action]):
             yield "", self.output_type()
 
     async def send(self, action: T_agent_action) -> None:
-        for output_channel, output_channel_type in self.output_channel_types.items():
-            await self.r.publish(
-                output_channel,
-                Message[output_channel_type](data=action).model_dump_json(),  # type:ignore[valid-type]
-            )
+        # Channels usually share a type, so serialize once per type, not per channel.
+        payloads: dict[type[T_agent_action], str] = {}
+        for output_channel, output_channel_type in self.output_channels:
+            if output_channel_type not in payloads:
+                payloads[output_channel_type] = Message[output_channel_type](  # type:ignore[valid-type]
+                    data=action
+                ).model_dump_json()
+            await self.queue_publish(output_channel, payloads[output_channel_type])
+
+    async def queue_publish(self, channel: str, payload: str) -> None:
+        """
+        Queue a publish; everything queued within one event loop iteration goes out in a single pipeline.
+        Returns without waiting for Redis unless MAX_PENDING_PUBLISHES are already waiting.
+        """
+        self._pending_publishes.append((channel, payload))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_publishes())
+            self._flush_task.add_done_callback(self._log_publish_error)
+        elif len(self._pending_publishes) >= MAX_PENDING_PUBLISHES:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+
+    @staticmethod
+    def _log_publish_error(task: asyncio.Task[None]) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            log.error("Failed to publish messages", exc_info=task.exception())
+
+    async def _flush_publishes(self) -> None:
+        # Publishes queued while a batch is in flight are picked up by the next loop.
+        while self._pending_publishes:
+            batch, self._pending_publishes = self._pending_publishes, []
+            async with self.r.pipeline(transaction=False) as pipe:
+                for channel, payload in batch:
+                    pipe.publish(channel, payload)
+                await pipe.execute()
 
     async def _task_scheduler(self) -> None:
         while not self.shutdown_event.is_set():
@@ -68,4 +115,4 @@ class BaseAgent(Node[T_agent_observation, T_agent_action]):
             action_or_none = await self.aact(observation)
             if action_or_none is not None:
                 await self.send(action_or_none)
-            self.observation_queue.task_done()
\ No newline at end of file
+            self.observation_queue.task_done()
@@ -1,13 +1,19 @@
+import asyncio
+import copy
+import functools
+import hashlib
 import logging
 import os
 import re
-from typing import TypeVar, Any, cast, Callable, ParamSpec
+from collections import OrderedDict
+from typing import TypeVar, Any, cast, Callable, Coroutine, ParamSpec
 
 import gin  # type: ignore[import-untyped]
 from beartype import beartype
 from beartype.typing import Type
 from openai import OpenAI
 
+from langchain_core.language_models import BaseChatModel
 from langchain_core.runnables.base import RunnableSerializable
 from langchain_core.messages.base import BaseMessage
 from langchain.output_parsers import PydanticOutputParser
@@ -17,11 +23,11 @@ from langchain.prompts import (
     PromptTemplate,
 )
 from langchain_core.prompt_values import ChatPromptValue
+from langchain_core.utils.pydantic import TBaseModel
 from langchain.schema import BaseOutputParser, OutputParserException
 from langchain_openai import ChatOpenAI, AzureChatOpenAI
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 from pydantic.v1 import SecretStr
-from rich import print
 from typing_extensions import Literal
 
 from sotopia.database import EnvironmentProfile, RelationshipProfile
@@ -40,6 +46,17 @@ load_dotenv()
 log = logging.getLogger("generate")
 logging_handler = LoggingCallbackHandler("langchain")
 
+# provider credentials, read once after load_dotenv() instead of on every chain build
+_API_KEYS: dict[str, str | None] = {
+    name: os.environ.get(name)
+    for name in (
+        "TOGETHER_API_KEY",
+        "GROQ_API_KEY",
+        "CUSTOM_API_KEY",
+        "OPENAI_API_KEY",
+    )
+}
+
 LLM_Name = Literal[
     "together_ai/meta-llama/Llama-2-7b-chat-hf",
     "together_ai/meta-llama/Llama-2-70b-chat-hf",
@@ -62,6 +79,16 @@ LLM_Name = Literal[
 # subject to future OpenAI changes
 DEFAULT_BAD_OUTPUT_PROCESS_MODEL = "gpt-4o-mini"
 
+# trailing commas before ) or ]
+_TRAILING_COMMA_RE = re.compile(r",\s*(\)|\])")
+# {var} placeholders; the lookbehind/lookahead skip escaped {{}}, and {ab{ab}ab} is not matched
+_TEMPLATE_VAR_RE = re.compile(r"(?<!{){([^{}]+)}(?!})")
+_BRACE_VAR_RE = re.compile(r"{(.*?)}")
+# markdown code fences, optionally tagged as json
+_CODE_FENCE_RE = re.compile(r"```(?:json)?")
+# trailing commas before } or ]
+_JSON_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
 OutputType = TypeVar("OutputType", bound=object)
 
 DecoratedCallable = TypeVar("DecoratedCallable", bound=Callable[..., Any])
@@ -74,6 +101,55 @@ def gin_configurable(f: Callable[P, T]) -> Callable[P, T]:
     return cast(Callable[P, T], decorated)
 
 
+# runtime type checking of the per-turn functions is opt-in via BEARTYPE=1
+BEARTYPE_HOT_PATH = os.environ.get("BEARTYPE", "0") == "1"
+
+
+def beartype_hot_path(f: DecoratedCallable) -> DecoratedCallable:
+    """beartype for functions called on every agent turn, only when BEARTYPE_HOT_PATH is set"""
+    if BEARTYPE_HOT_PATH:
+        return beartype(f)
+    return f
+
+
+# exact-match LRU cache for opt-in profile generation, keyed by _profile_cache_key
+PROFILE_CACHE_SIZE = 128
+_PROFILE_CACHE: OrderedDict[str, Any] = OrderedDict()
+
+
+def _profile_cache_key(*parts: object) -> str:
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+def _profile_cache_get(key: str) -> Any:
+    """Return a copy of the cached profile, or None on a miss"""
+    if key not in _PROFILE_CACHE:
+        return None
+    _PROFILE_CACHE.move_to_end(key)
+    return copy.deepcopy(_PROFILE_CACHE[key])
+
+
+def _profile_cache_put(key: str, value: Any) -> None:
+    _PROFILE_CACHE[key] = copy.deepcopy(value)
+    _PROFILE_CACHE.move_to_end(key)
+    if len(_PROFILE_CACHE) > PROFILE_CACHE_SIZE:
+        _PROFILE_CACHE.popitem(last=False)
+
+
+# format instructions per pydantic model; the schemas are static, so render them once
+_FORMAT_INSTRUCTIONS_CACHE: dict[Any, str] = {}
+
+
+class SchemaCachedPydanticOutputParser(PydanticOutputParser[TBaseModel]):
+    def get_format_instructions(self) -> str:
+        """Return the format instructions, building the JSON schema only once per model."""
+        if self.pydantic_object not in _FORMAT_INSTRUCTIONS_CACHE:
+            _FORMAT_INSTRUCTIONS_CACHE[self.pydantic_object] = (
+                super().get_format_instructions()
+            )
+        return _FORMAT_INSTRUCTIONS_CACHE[self.pydantic_object]
+
+
 class EnvResponse(BaseModel):
     reasoning: str = Field(
         description="first reiterate agents' social goals and then reason about what agents say/do and whether that aligns with their goals."
@@ -82,7 +158,7 @@ class EnvResponse(BaseModel):
     p2_rate: int = Field(description="rating of participant 2, on the scale of 0 to 9")
 
 
-class EnvResponsePydanticOutputParser(PydanticOutputParser[EnvResponse]):
+class EnvResponsePydanticOutputParser(SchemaCachedPydanticOutputParser[EnvResponse]):
     def __init__(self, pydantic_object: Type[EnvResponse] = EnvResponse) -> None:
         super(EnvResponsePydanticOutputParser, self).__init__(
             pydantic_object=pydantic_object
@@ -90,14 +166,31 @@ class EnvResponsePydanticOutputParser(PydanticOutputParser[EnvResponse]):
 
     def parse(self, text: str) -> EnvResponse:
         # remove trailing commas before ) or ] from text
-        text = re.sub(r",\s*(\)|\])", r"\1", text)
-        return super().parse(text)
+        text = _TRAILING_COMMA_RE.sub(r"\1", text)
+        try:
+            # bare JSON is decoded and validated in a single pass by pydantic-core
+            return cast(EnvResponse, self.pydantic_object.model_validate_json(text))
+        except ValidationError:
+            # e.g. JSON wrapped in markdown fences; let langchain extract it
+            return super().parse(text)
 
     def get_format_instructions(self) -> str:
         format_instruction = super().get_format_instructions()
         return format_instruction
 
 
+@functools.lru_cache(maxsize=None)
+def _list_of_int_description_text(
+    number_of_int: int | None, range_of_int: tuple[int, int] | None
+) -> str:
+    return f"a list of{' ' + str(number_of_int) if number_of_int else ''} intergers{' within the range of' + str(range_of_int) if range_of_int else ''} separated by spaces. Don't output anything else. Format example: 1 2 3 4 5"
+
+
+@functools.lru_cache(maxsize=None)
+def _list_of_str_description_text(number_of_str: int | None) -> str:
+    return f"a list of{' ' + str(number_of_str) if number_of_str else ''} strings separated by space"
+
+
 class ListOfIntOutputParser(BaseOutputParser[list[int]]):
     number_of_int: int | None
     range_of_int: tuple[int, int] | None
@@ -118,23 +211,25 @@ class ListOfIntOutputParser(BaseOutputParser[list[int]]):
         self.range_of_int = range_of_int
 
     def _get_description_text(self) -> str:
-        return f"a list of{' ' + str(self.number_of_int) if self.number_of_int else ''} intergers{' within the range of' + str(self.range_of_int) if self.range_of_int else ''} separated by spaces. Don't output anything else. Format example: 1 2 3 4 5"
+        return _list_of_int_description_text(self.number_of_int, self.range_of_int)
 
     def get_format_instructions(self) -> str:
         return "Please output " + self._get_description_text()
 
     def parse(self, output: str) -> list[int]:
         try:
-            output_loaded = output.split(" ")
+            output_loaded = output.split()
             result = [int(x) for x in output_loaded]
             if self.number_of_int and len(result) != self.number_of_int:
                 msg = f"Expect {self.number_of_int} integers, got {len(result)}"
                 raise OutputParserException(msg)
-            if self.range_of_int:
-                for x in result:
-                    if x < self.range_of_int[0] or x > self.range_of_int[1]:
-                        msg = f"Expect integers within the range of {self.range_of_int}, got {result}"
-                        raise OutputParserException(msg)
+            if self.range_of_int and result:
+                if (
+                    min(result) < self.range_of_int[0]
+                    or max(result) > self.range_of_int[1]
+                ):
+                    msg = f"Expect integers within the range of {self.range_of_int}, got {result}"
+                    raise OutputParserException(msg)
             return result
         except KeyboardInterrupt:
             raise KeyboardInterrupt
@@ -165,14 +260,14 @@ class ListOfStrOutputParser(BaseOutputParser[list[str]]):
         self.number_of_str = number_of_str
 
     def _get_description_text(self) -> str:
-        return f"a list of{' ' + str(self.number_of_str) if self.number_of_str else ''} strings separated by space"
+        return _list_of_str_description_text(self.number_of_str)
 
     def get_format_instructions(self) -> str:
         return "Please output " + self._get_description_text()
 
     def parse(self, output: str) -> list[str]:
         try:
-            result = output.split(" ")
+            result = output.split()
             if self.number_of_str and len(result) != self.number_of_str:
                 msg = f"Expect {self.number_of_str} strings, got {len(result)}"
                 raise OutputParserException(msg)
@@ -205,6 +300,10 @@ class StrOutputParser(BaseOutputParser[str]):
         return "str"
 
 
+# StrOutputParser holds no state, so one instance serves every call.
+_STR_PARSER = StrOutputParser()
+
+
 class ScriptOutputParser(BaseOutputParser[ScriptInteractionReturnType]):
     agent_names: list[str] = Field(
         description="The names of the two agents in the conversation"
@@ -260,7 +359,7 @@ f. Oliver Thompson left the conversation"""
         Parse the loosely formatted output to AgentAction
         We make the reformat in this function
         """
-        print("Original output: ", output)
+        log.debug("Original output: %s", output)
         interaction = ScriptInteraction(interactions=output)
         agent_names = self.agent_names
         assert len(agent_names) == 2, "agent_names must have length 2"
@@ -281,27 +380,31 @@ f. Oliver Thompson left the conversation"""
         return "str"
 
 
+_FIXED_MODEL_VERSIONS = {
+    "gpt-3.5-turbo": "gpt-3.5-turbo-0125",
+    "gpt-3.5-turbo-finetuned": "ft:gpt-3.5-turbo-0613:academicscmu::8nY2zgdt",
+    "gpt-3.5-turbo-ft-MF": "ft:gpt-3.5-turbo-0613:academicscmu::8nuER4bO",
+    "gpt-4": "gpt-4-0613",
+    "gpt-4-turbo": "gpt-4-1106-preview",
+}
+
+
 def _return_fixed_model_version(model_name: str) -> str:
-    if model_name in [
-        "gpt-3.5-turbo",
-        "gpt-3.5-turbo-finetuned",
-        "gpt-3.5-turbo-ft-MF",
-        "gpt-4",
-        "gpt-4-turbo",
-    ]:
-        return {
-            "gpt-3.5-turbo": "gpt-3.5-turbo-0125",
-            "gpt-3.5-turbo-finetuned": "ft:gpt-3.5-turbo-0613:academicscmu::8nY2zgdt",
-            "gpt-3.5-turbo-ft-MF": "ft:gpt-3.5-turbo-0613:academicscmu::8nuER4bO",
-            "gpt-4": "gpt-4-0613",
-            "gpt-4-turbo": "gpt-4-1106-preview",
-        }[model_name]
-    else:
-        return model_name
+    return _FIXED_MODEL_VERSIONS.get(model_name, model_name)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_openai_client(
+    base_url: str | None = None, api_key: str | None = None
+) -> OpenAI:
+    """
+    Share one OpenAI client (and its connection pool) per endpoint and key
+    """
+    return OpenAI(base_url=base_url, api_key=api_key)
 
 
 @gin_configurable
-@beartype
+@beartype_hot_path
 def obtain_chain(
     model_name: str,
     template: str,
@@ -313,6 +416,29 @@ def obtain_chain(
     """
     Using langchain to sample profiles for participants
     """
+    return _build_chain(
+        model_name,
+        template,
+        tuple(input_variables),
+        temperature,
+        max_retries,
+        use_fixed_model_version,
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def _build_chain(
+    model_name: str,
+    template: str,
+    input_variables_tuple: tuple[str, ...],
+    temperature: float,
+    max_retries: int,
+    use_fixed_model_version: bool,
+) -> RunnableSerializable[dict[Any, Any], BaseMessage]:
+    """
+    Build the prompt | model chain; cached since chains are stateless and reusable
+    """
+    input_variables = list(input_variables_tuple)
     human_message_prompt = HumanMessagePromptTemplate(
         prompt=PromptTemplate(
             template=template,
@@ -322,84 +448,102 @@ def obtain_chain(
     chat_prompt_template = ChatPromptTemplate.from_messages([human_message_prompt])
     if use_fixed_model_version:
         model_name = _return_fixed_model_version(model_name)
-    if model_name.startswith("together_ai"):
-        model_name = "/".join(model_name.split("/")[1:])
-        assert (
-            TOGETHER_API_KEY := os.environ.get("TOGETHER_API_KEY")
-        ), "TOGETHER_API_KEY is not set"
-        chat_openai = ChatOpenAI(
-            name=model_name,
-            temperature=temperature,
-            max_retries=max_retries,
-            base_url="https://api.together.xyz/v1",
-            api_key=SecretStr(TOGETHER_API_KEY),
-        )
-        chain = chat_prompt_template | chat_openai
-        return chain
-    elif model_name.startswith("groq"):
-        model_name = "/".join(model_name.split("/")[1:])
-        assert (
-            GROQ_API_KEY := os.environ.get("GROQ_API_KEY")
-        ), "GROQ_API_KEY is not set"
-        chat_openai = ChatOpenAI(
-            name=model_name,
-            temperature=temperature,
-            max_retries=max_retries,
-            base_url="https://api.groq.com/openai/v1",
-            api_key=SecretStr(GROQ_API_KEY),
-        )
-        chain = chat_prompt_template | chat_openai
-        return chain
-    elif model_name.startswith("azure"):
-        # azure/resource_name/deployment_name/version
-        azure_credentials = model_name.split("/")[1:]
-        resource_name, deployment_name, azure_version = (
-            azure_credentials[0],
-            azure_credentials[1],
-            azure_credentials[2],
-        )
-        chat_azure_openai = AzureChatOpenAI(
-            azure_deployment=deployment_name,
-            api_version=azure_version,
-            azure_endpoint=f"https://{resource_name}.openai.azure.com",
-            temperature=temperature,
-            max_retries=max_retries,
-        )
-        chain = chat_prompt_template | chat_azure_openai
-        return chain
-    elif model_name.startswith("custom"):
-        custom_model_name, model_base_url = (
-            model_name.split("@")[0],
-            model_name.split("@")[1],
-        )
-        custom_model_name = "/".join(custom_model_name.split("/")[1:])
-        chat = ChatOpenAI(
-            model=custom_model_name,
-            temperature=temperature,
-            max_retries=max_retries,
-            api_key=SecretStr(
-                CUSTOM_API_KEY
-                if (CUSTOM_API_KEY := os.environ.get("CUSTOM_API_KEY"))
-                else "EMPTY"
-            ),
-            base_url=model_base_url,
-        )
-        human_message_prompt = HumanMessagePromptTemplate(
-            prompt=PromptTemplate(template=template, input_variables=input_variables)
-        )
-        chat_prompt_template = ChatPromptTemplate.from_messages([human_message_prompt])
-        chain = chat_prompt_template | chat
-        return chain
-    else:
-        chat = ChatOpenAI(
-            model=model_name,
-            temperature=temperature,
-            max_retries=max_retries,
-            # base_url="http://tiger.lti.cs.cmu.edu:4000",
-            api_key=SecretStr(os.environ.get("OPENAI_API_KEY", ""))
-        )
-        chain = chat_prompt_template | chat
-        return chain
+    provider = _PROVIDER_PREFIX_RE.split(model_name, maxsplit=1)[0]
+    build_chat_model = _CHAT_MODEL_BUILDERS.get(provider, _build_openai_chat_model)
+    chain = chat_prompt_template | build_chat_model(
+        model_name, temperature, max_retries
+    )
+    return chain
+
+
+def _build_together_chat_model(
+    model_name: str, temperature: float, max_retries: int
+) -> BaseChatModel:
+    model_name = "/".join(model_name.split("/")[1:])
+    assert (
+        TOGETHER_API_KEY := _API_KEYS["TOGETHER_API_KEY"]
+    ), "TOGETHER_API_KEY is not set"
+    return ChatOpenAI(
+        name=model_name,
+        temperature=temperature,
+        max_retries=max_retries,
+        base_url="https://api.together.xyz/v1",
+        api_key=SecretStr(TOGETHER_API_KEY),
+    )
+
+
+def _build_groq_chat_model(
+    model_name: str, temperature: float, max_retries: int
+) -> BaseChatModel:
+    model_name = "/".join(model_name.split("/")[1:])
+    assert (
+        GROQ_API_KEY := _API_KEYS["GROQ_API_KEY"]
+    ), "GROQ_API_KEY is not set"
+    return ChatOpenAI(
+        name=model_name,
+        temperature=temperature,
+        max_retries=max_retries,
+        base_url="https://api.groq.com/openai/v1",
+        api_key=SecretStr(GROQ_API_KEY),
+    )
+
+
+def _build_azure_chat_model(
+    model_name: str, temperature: float, max_retries: int
+) -> BaseChatModel:
+    # azure/resource_name/deployment_name/version
+    azure_credentials = model_name.split("/")[1:]
+    resource_name, deployment_name, azure_version = (
+        azure_credentials[0],
+        azure_credentials[1],
+        azure_credentials[2],
+    )
+    return AzureChatOpenAI(
+        azure_deployment=deployment_name,
+        api_version=azure_version,
+        azure_endpoint=f"https://{resource_name}.openai.azure.com",
+        temperature=temperature,
+        max_retries=max_retries,
+    )
+
+
+def _build_custom_chat_model(
+    model_name: str, temperature: float, max_retries: int
+) -> BaseChatModel:
+    custom_model_name, model_base_url = (
+        model_name.split("@")[0],
+        model_name.split("@")[1],
+    )
+    custom_model_name = "/".join(custom_model_name.split("/")[1:])
+    return ChatOpenAI(
+        model=custom_model_name,
+        temperature=temperature,
+        max_retries=max_retries,
+        api_key=SecretStr(_API_KEYS["CUSTOM_API_KEY"] or "EMPTY"),
+        base_url=model_base_url,
+    )
+
+
+def _build_openai_chat_model(
+    model_name: str, temperature: float, max_retries: int
+) -> BaseChatModel:
+    return ChatOpenAI(
+        model=model_name,
+        temperature=temperature,
+        max_retries=max_retries,
+        # base_url="http://tiger.lti.cs.cmu.edu:4000",
+        api_key=SecretStr(_API_KEYS["OPENAI_API_KEY"] or ""),
+    )
+
+
+# model_name prefix (before the first "/" or "@") -> chat model builder; anything else is OpenAI
+_PROVIDER_PREFIX_RE = re.compile(r"[/@]")
+_CHAT_MODEL_BUILDERS: dict[str, Callable[[str, float, int], BaseChatModel]] = {
+    "together_ai": _build_together_chat_model,
+    "groq": _build_groq_chat_model,
+    "azure": _build_azure_chat_model,
+    "custom": _build_custom_chat_model,
+}
 
 
 @beartype
@@ -422,11 +566,11 @@ def format_bad_output_for_script(
 
     Please only generate the rewritten string:
     """
-    print("ill_formed_output: ", ill_formed_output)
+    log.debug("ill_formed_output: %s", ill_formed_output)
     chain = obtain_chain(
         model_name=model_name,
         template=template,
-        input_variables=re.findall(r"{(.*?)}", template),
+        input_variables=_BRACE_VAR_RE.findall(template),
         use_fixed_model_version=use_fixed_model_version,
     )
     input_values = {
@@ -435,11 +579,22 @@ def format_bad_output_for_script(
         "agents": agents,
     }
     reformat = chain.invoke(input_values, config={"callbacks": [logging_handler]})
-    log.info(f"Reformated output: {reformat}")
+    log.info("Reformated output: %s", reformat)
     return reformat
 
 
-@beartype
+def _repair_json_output(text: str) -> str:
+    """
+    Fix common JSON slips locally: code fences, prose around the object, and trailing commas
+    """
+    text = _CODE_FENCE_RE.sub("", text)
+    start, end = text.find("{"), text.rfind("}")
+    if start != -1 and end > start:
+        text = text[start : end + 1]
+    return _JSON_TRAILING_COMMA_RE.sub(r"\1", text).strip()
+
+
+@beartype_hot_path
 def format_bad_output(
     ill_formed_output: BaseMessage,
     format_instructions: str,
@@ -457,7 +612,7 @@ def format_bad_output(
     chain = obtain_chain(
         model_name=model_name,
         template=template,
-        input_variables=re.findall(r"{(.*?)}", template),
+        input_variables=_BRACE_VAR_RE.findall(template),
         use_fixed_model_version=use_fixed_model_version,
     )
     input_values = {
@@ -465,12 +620,20 @@ def format_bad_output(
         "format_instructions": format_instructions,
     }
     reformat = chain.invoke(input_values, config={"callbacks": [logging_handler]})
-    log.info(f"Reformated output: {reformat}")
+    log.info("Reformated output: %s", reformat)
     return reformat
 
 
+@functools.lru_cache(maxsize=128)
+def _prepare_template(template: str) -> tuple[str, tuple[str, ...]]:
+    """
+    Return the processed template and its input variables; templates are constants, so cache them
+    """
+    return format_docstring(template), tuple(_TEMPLATE_VAR_RE.findall(template))
+
+
 @gin_configurable
-@beartype
+@beartype_hot_path
 async def agenerate(
     model_name: str,
     template: str,
@@ -481,22 +644,12 @@ async def agenerate(
     bad_output_process_model: str | None = None,
     use_fixed_model_version: bool = True,
 ) -> OutputType:
-    input_variables = re.findall(
-        r"(?<!{){([^{}]+)}(?!})", template
-    )  # Add negative lookbehind and lookahead to avoid matching {{}}; note that {ab{ab}ab} will not be matched
+    template, template_variables = _prepare_template(template)
+    input_variables = list(template_variables)
     assert (
         set(input_variables) == set(list(input_values.keys()) + ["format_instructions"])
         or set(input_variables) == set(list(input_values.keys()))
     ), f"The variables in the template must match input_values except for format_instructions. Got {sorted(input_values.keys())}, expect {sorted(input_variables)}"
-    # process template
-    template = format_docstring(template)
-    chain = obtain_chain(
-        model_name=model_name,
-        template=template,
-        input_variables=input_variables,
-        temperature=temperature,
-        use_fixed_model_version=use_fixed_model_version,
-    )
 
     if "format_instructions" not in input_values:
         input_values["format_instructions"] = output_parser.get_format_instructions()
@@ -518,13 +671,13 @@ async def agenerate(
         assert isinstance(output_parser, PydanticOutputParser)
         assert isinstance(instantiated_prompt, str)
         if model_name.startswith("custom"):
-            client = OpenAI(
+            client = _get_openai_client(
                 base_url=model_name.split("@")[1],
-                api_key=os.environ.get("CUSTOM_API_KEY") or "EMPTY",
+                api_key=_API_KEYS["CUSTOM_API_KEY"] or "EMPTY",
             )
             model_name = model_name.split("@")[0].split("/")[1]
         else:
-            client = OpenAI()
+            client = _get_openai_client()
 
         completion = client.beta.chat.completions.parse(
             model=model_name,
@@ -537,24 +690,52 @@ async def agenerate(
         casted_result = cast(OutputType, result)
         return casted_result
 
+    chain = obtain_chain(
+        model_name=model_name,
+        template=template,
+        input_variables=input_variables,
+        temperature=temperature,
+        use_fixed_model_version=use_fixed_model_version,
+    )
     result = await chain.ainvoke(input_values, config={"callbacks": [logging_handler]})
+    # bound before the isinstance check so the narrowing does not reach the callable
+    parse_output: Callable[[BaseMessage], OutputType] = output_parser.invoke
     try:
-        parsed_result = output_parser.invoke(result)
+        if isinstance(output_parser, ScriptOutputParser):
+            # script parsing is CPU-heavy for long scripts; keep it off the event loop
+            parsed_result = await asyncio.to_thread(parse_output, result)
+        else:
+            parsed_result = parse_output(result)
     except Exception as e:
         if isinstance(output_parser, ScriptOutputParser):
             raise e  # the problem has been handled in the parser
         log.debug(
-            f"[red] Failed to parse result: {result}\nEncounter Exception {e}\nstart to reparse",
-            extra={"markup": True},
-        )
-        reformat_parsed_result = format_bad_output(
+            "[red] Failed to parse result: %s\nEncounter Exception %s\nstart to reparse",
             result,
-            format_instructions=output_parser.get_format_instructions(),
-            model_name=bad_output_process_model or model_name,
-            use_fixed_model_version=use_fixed_model_version,
+            e,
+            extra={"markup": True},
         )
-        parsed_result = output_parser.invoke(reformat_parsed_result)
-    log.info(f"Generated result: {parsed_result}")
+        repaired = False
+        # cheap local repair first; only pay for an LLM reformat if it is not enough.
+        # Only JSON models are repaired: cutting list or free-text output down to its
+        # outermost braces could make the wrong content parse.
+        if isinstance(output_parser, PydanticOutputParser):
+            try:
+                parsed_result = output_parser.invoke(
+                    _repair_json_output(str(result.content))
+                )
+                repaired = True
+            except Exception:
+                pass
+        if not repaired:
+            reformat_parsed_result = format_bad_output(
+                result,
+                format_instructions=output_parser.get_format_instructions(),
+                model_name=bad_output_process_model or model_name,
+                use_fixed_model_version=use_fixed_model_version,
+            )
+            parsed_result = output_parser.invoke(reformat_parsed_result)
+    log.info("Generated result: %s", parsed_result)
     return parsed_result
 
 
@@ -567,10 +748,23 @@ async def agenerate_env_profile(
     temperature: float = 0.7,
     bad_output_process_model: str | None = None,
     use_fixed_model_version: bool = True,
+    use_cache: bool = False,
 ) -> tuple[EnvironmentProfile, str]:
     """
     Using langchain to generate the background
+    If use_cache is set, identical requests reuse the previously generated profile.
     """
+    cache_key = _profile_cache_key(
+        "env_profile",
+        model_name,
+        inspiration_prompt,
+        examples,
+        temperature,
+        bad_output_process_model,
+        use_fixed_model_version,
+    )
+    if use_cache and (cached := _profile_cache_get(cache_key)) is not None:
+        return cast(tuple[EnvironmentProfile, str], cached)
     result = await agenerate(
         model_name=model_name,
         template="""Please generate scenarios and goals based on the examples below as well as the inspirational prompt, when creating the goals, try to find one point that both sides may not agree upon initially and need to collaboratively resolve it.
@@ -584,11 +778,13 @@ async def agenerate_env_profile(
             inspiration_prompt=inspiration_prompt,
             examples=examples,
         ),
-        output_parser=PydanticOutputParser(pydantic_object=EnvironmentProfile),
+        output_parser=SchemaCachedPydanticOutputParser(pydantic_object=EnvironmentProfile),
         temperature=temperature,
         bad_output_process_model=bad_output_process_model,
         use_fixed_model_version=use_fixed_model_version,
     )
+    if use_cache:
+        _profile_cache_put(cache_key, result)
     return cast(tuple[EnvironmentProfile, str], result)
 
 
@@ -598,11 +794,22 @@ async def agenerate_relationship_profile(
     agents_profiles: list[str],
     bad_output_process_model: str | None = None,
     use_fixed_model_version: bool = True,
+    use_cache: bool = False,
 ) -> tuple[RelationshipProfile, str]:
     """
     Using langchain to generate the background
+    If use_cache is set, identical requests reuse the previously generated profile.
     """
     agent_profile = "\n".join(agents_profiles)
+    cache_key = _profile_cache_key(
+        "relationship_profile",
+        model_name,
+        agent_profile,
+        bad_output_process_model,
+        use_fixed_model_version,
+    )
+    if use_cache and (cached := _profile_cache_get(cache_key)) is not None:
+        return cast(tuple[RelationshipProfile, str], cached)
     result = await agenerate(
         model_name=model_name,
         template="""Please generate relationship between two agents based on the agents' profiles below. Note that you generate
@@ -613,15 +820,17 @@ async def agenerate_relationship_profile(
         input_values=dict(
             agent_profile=agent_profile,
         ),
-        output_parser=PydanticOutputParser(pydantic_object=RelationshipProfile),
+        output_parser=SchemaCachedPydanticOutputParser(pydantic_object=RelationshipProfile),
         bad_output_process_model=bad_output_process_model,
         use_fixed_model_version=use_fixed_model_version,
     )
+    if use_cache:
+        _profile_cache_put(cache_key, result)
     return cast(tuple[RelationshipProfile, str], result)
 
 
 @gin_configurable
-@beartype
+@beartype_hot_path
 async def agenerate_action(
     model_name: str,
     history: str,
@@ -638,6 +847,8 @@ async def agenerate_action(
     Using langchain to generate an example episode
     """
     try:
+        # Static instructions come first and per-turn fields ({history}, {turn_number},
+        # {action_list}) last, so turns share a prompt prefix providers can cache.
         if script_like:
             # model as playwright
             template = """
@@ -645,14 +856,15 @@ async def agenerate_action(
                 You can find {agent}'s background and goal in the 'Here is the context of the interaction' field.
                 You should try your best to achieve {agent}'s goal in a way that align with their character traits.
                 Additionally, maintaining the conversation's naturalness and realism is essential (e.g., do not repeat what other people has already said before).
-                {history}.
-                The script has proceeded to Turn #{turn_number}. Current available action types are
-                {action_list}.
                 Note: The script can be ended if 1. one agent have achieved social goals, 2. this conversation makes the agent uncomfortable, 3. the agent find it uninteresting/you lose your patience, 4. or for other reasons you think it should stop.
 
                 Please only generate a JSON string including the action type and the argument.
                 Your action should follow the given format:
                 {format_instructions}
+
+                {history}.
+                The script has proceeded to Turn #{turn_number}. Current available action types are
+                {action_list}.
             """
         else:
             # Normal case, model as agent
@@ -662,14 +874,15 @@ async def agenerate_action(
                 Note that {agent}'s goal is only visible to you.
                 You should try your best to achieve {agent}'s goal in a way that align with their character traits.
                 Additionally, maintaining the conversation's naturalness and realism is essential (e.g., do not repeat what other people has already said before).
-                {history}.
-                You are at Turn #{turn_number}. Your available action types are
-                {action_list}.
                 Note: You can "leave" this conversation if 1. you have achieved your social goals, 2. this conversation makes you uncomfortable, 3. you find it uninteresting/you lose your patience, 4. or for other reasons you want to leave.
 
                 Please only generate a JSON string including the action type and the argument.
                 Your action should follow the given format:
                 {format_instructions}
+
+                {history}.
+                You are at Turn #{turn_number}. Your available action types are
+                {action_list}.
             """
         result = await agenerate(
             model_name=model_name,
@@ -680,7 +893,7 @@ async def agenerate_action(
                 history=history,
                 action_list=" ".join(action_types),
             ),
-            output_parser=PydanticOutputParser(pydantic_object=AgentAction),
+            output_parser=SchemaCachedPydanticOutputParser(pydantic_object=AgentAction),
             temperature=temperature,
             bad_output_process_model=bad_output_process_model,
             use_fixed_model_version=use_fixed_model_version,
@@ -690,6 +903,63 @@ async def agenerate_action(
         return AgentAction(action_type="none", argument="")
 
 
+async def _gather_with_concurrency(
+    coroutines: list[Coroutine[Any, Any, T]], max_concurrency: int
+) -> list[T]:
+    """
+    Run the coroutines concurrently, with at most max_concurrency in flight, keeping input order
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _run(coroutine: Coroutine[Any, Any, T]) -> T:
+        async with semaphore:
+            return await coroutine
+
+    return list(await asyncio.gather(*(_run(coroutine) for coroutine in coroutines)))
+
+
+@beartype_hot_path
+async def agenerate_actions_for_turn(
+    model_name: str,
+    history: str,
+    turn_number: int,
+    agents: list[str],
+    goals: list[str],
+    action_types: list[list[ActionType]],
+    temperature: float = 0.7,
+    script_like: bool = False,
+    bad_output_process_model: str | None = None,
+    use_fixed_model_version: bool = True,
+    max_concurrency: int = 8,
+) -> list[AgentAction]:
+    """
+    Generate one action per agent for the same turn concurrently
+    The agents' prompts are independent, so their LLM calls overlap instead of running back to back.
+    Actions are returned in the order of agents.
+    """
+    assert (
+        len(agents) == len(goals) == len(action_types)
+    ), "agents, goals and action_types must have the same length"
+    return await _gather_with_concurrency(
+        [
+            agenerate_action(
+                model_name=model_name,
+                history=history,
+                turn_number=turn_number,
+                action_types=agent_action_types,
+                agent=agent,
+                goal=goal,
+                temperature=temperature,
+                script_like=script_like,
+                bad_output_process_model=bad_output_process_model,
+                use_fixed_model_version=use_fixed_model_version,
+            )
+            for agent, goal, agent_action_types in zip(agents, goals, action_types)
+        ],
+        max_concurrency,
+    )
+
+
 @gin_configurable
 @beartype
 async def agenerate_script(
@@ -764,7 +1034,7 @@ async def agenerate_script(
         return cast(tuple[ScriptInteractionReturnType, str], result)
     except Exception as e:
         # TODO raise(e) # Maybe we do not want to return anything?
-        print(f"Exception in agenerate {e}")
+        log.exception("Exception in agenerate %s", e)
         return_default_value: ScriptInteractionReturnType = (
             ScriptInteraction.default_value_for_return_type()
         )
@@ -788,19 +1058,7 @@ def process_history(
     return result
 
 
-@beartype
-async def agenerate_init_profile(
-    model_name: str,
-    basic_info: dict[str, str],
-    bad_output_process_model: str | None = None,
-    use_fixed_model_version: bool = True,
-) -> str:
-    """
-    Using langchain to generate the background
-    """
-    result = await agenerate(
-        model_name=model_name,
-        template="""Please expand a fictional background for {name}. Here is the basic information:
+_INIT_PROFILE_TEMPLATE = """Please expand a fictional background for {name}. Here is the basic information:
             {name}'s age: {age}
             {name}'s gender identity: {gender_identity}
             {name}'s pronouns: {pronoun}
@@ -814,7 +1072,22 @@ async def agenerate_init_profile(
             Then expand the personal backgrounds with concrete details (e.g, look, family, hobbies, friends and etc.)
             For the personality and values (e.g., MBTI, moral foundation, and etc.),
             remember to use examples and behaviors in the person's life to demonstrate it.
-            """,
+            """
+
+
+@beartype
+async def agenerate_init_profile(
+    model_name: str,
+    basic_info: dict[str, str],
+    bad_output_process_model: str | None = None,
+    use_fixed_model_version: bool = True,
+) -> str:
+    """
+    Using langchain to generate the background
+    """
+    result = await agenerate(
+        model_name=model_name,
+        template=_INIT_PROFILE_TEMPLATE,
         input_values=dict(
             name=basic_info["name"],
             age=basic_info["age"],
@@ -827,13 +1100,23 @@ async def agenerate_init_profile(
             decision_style=basic_info["Decision_making_Style"],
             secret=basic_info["secret"],
         ),
-        output_parser=StrOutputParser(),
+        output_parser=_STR_PARSER,
         bad_output_process_model=bad_output_process_model,
         use_fixed_model_version=use_fixed_model_version,
     )
     return result
 
 
+_NARRATIVE_TEMPLATES = {
+    "first": """Please convert the following text into a first-person narrative.
+            e.g, replace name, he, she, him, her, his, and hers with I, me, my, and mine.
+            {text}""",
+    "second": """Please convert the following text into a second-person narrative.
+            e.g, replace name, he, she, him, her, his, and hers with you, your, and yours.
+            {text}""",
+}
+
+
 @beartype
 async def convert_narratives(
     model_name: str,
@@ -842,33 +1125,24 @@ async def convert_narratives(
     bad_output_process_model: str | None = None,
     use_fixed_model_version: bool = True,
 ) -> str:
-    if narrative == "first":
-        result = await agenerate(
-            model_name=model_name,
-            template="""Please convert the following text into a first-person narrative.
-            e.g, replace name, he, she, him, her, his, and hers with I, me, my, and mine.
-            {text}""",
-            input_values=dict(text=text),
-            output_parser=StrOutputParser(),
-            bad_output_process_model=bad_output_process_model,
-            use_fixed_model_version=use_fixed_model_version,
-        )
-    elif narrative == "second":
-        result = await agenerate(
-            model_name=model_name,
-            template="""Please convert the following text into a second-person narrative.
-            e.g, replace name, he, she, him, her, his, and hers with you, your, and yours.
-            {text}""",
-            input_values=dict(text=text),
-            output_parser=StrOutputParser(),
-            bad_output_process_model=bad_output_process_model,
-            use_fixed_model_version=use_fixed_model_version,
-        )
-    else:
+    if narrative not in _NARRATIVE_TEMPLATES:
         raise ValueError(f"Narrative {narrative} is not supported.")
+    result = await agenerate(
+        model_name=model_name,
+        template=_NARRATIVE_TEMPLATES[narrative],
+        input_values=dict(text=text),
+        output_parser=_STR_PARSER,
+        bad_output_process_model=bad_output_process_model,
+        use_fixed_model_version=use_fixed_model_version,
+    )
     return result
 
 
+_GOAL_TEMPLATE = """Please generate your goal based on the background:
+            {background}
+            """
+
+
 @beartype
 async def agenerate_goal(
     model_name: str,
@@ -881,12 +1155,87 @@ async def agenerate_goal(
     """
     result = await agenerate(
         model_name=model_name,
-        template="""Please generate your goal based on the background:
-            {background}
-            """,
+        template=_GOAL_TEMPLATE,
         input_values=dict(background=background),
-        output_parser=StrOutputParser(),
+        output_parser=_STR_PARSER,
         bad_output_process_model=bad_output_process_model,
         use_fixed_model_version=use_fixed_model_version,
     )
-    return result
\ No newline at end of file
+    return result
+
+
+@beartype
+async def agenerate_init_profiles(
+    model_name: str,
+    basic_infos: list[dict[str, str]],
+    bad_output_process_model: str | None = None,
+    use_fixed_model_version: bool = True,
+    max_concurrency: int = 8,
+) -> list[str]:
+    """
+    Generate the backgrounds for several agents concurrently, in the order of basic_infos
+    """
+    return await _gather_with_concurrency(
+        [
+            agenerate_init_profile(
+                model_name=model_name,
+                basic_info=basic_info,
+                bad_output_process_model=bad_output_process_model,
+                use_fixed_model_version=use_fixed_model_version,
+            )
+            for basic_info in basic_infos
+        ],
+        max_concurrency,
+    )
+
+
+@beartype
+async def convert_narratives_batch(
+    model_name: str,
+    narrative: str,
+    texts: list[str],
+    bad_output_process_model: str | None = None,
+    use_fixed_model_version: bool = True,
+    max_concurrency: int = 8,
+) -> list[str]:
+    """
+    Convert several texts to the same narrative concurrently, in the order of texts
+    """
+    return await _gather_with_concurrency(
+        [
+            convert_narratives(
+                model_name=model_name,
+                narrative=narrative,
+                text=text,
+                bad_output_process_model=bad_output_process_model,
+                use_fixed_model_version=use_fixed_model_version,
+            )
+            for text in texts
+        ],
+        max_concurrency,
+    )
+
+
+@beartype
+async def agenerate_goals(
+    model_name: str,
+    backgrounds: list[str],
+    bad_output_process_model: str | None = None,
+    use_fixed_model_version: bool = True,
+    max_concurrency: int = 8,
+) -> list[str]:
+    """
+    Generate the goals for several backgrounds concurrently, in the order of backgrounds
+    """
+    return await _gather_with_concurrency(
+        [
+            agenerate_goal(
+                model_name=model_name,
+                background=background,
+                bad_output_process_model=bad_output_process_model,
+                use_fixed_model_version=use_fixed_model_version,
+            )
+            for background in backgrounds
+        ],
+        max_concurrency,
+    )
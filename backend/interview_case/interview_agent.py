@@ -1,10 +1,13 @@
+import functools
 import logging
+import re
 import sys
+from collections import deque
 from enum import Enum
 from rich.logging import RichHandler
 from pydantic import Field
 
-from typing import Optional
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
 
 from aact import Message, NodeFactory
 from aact.messages import Text, Tick, DataModel
@@ -31,8 +34,23 @@ logging.basicConfig(
     handlers=[RichHandler()],
 )
 
+# Markdown code fences (optionally tagged as json) that models wrap replies in
+_CODE_FENCE_RE = re.compile(r"```(?:json)?")
 
-class ActionType(Enum):
+
+def _load_agent_reply(reply: str) -> Any:
+    """Decode the agent's JSON reply, stripping markdown fences only if needed."""
+    try:
+        data = json.loads(reply)
+    except json.JSONDecodeError:
+        pass
+    else:
+        if isinstance(data, dict):
+            return data
+    return json.loads(_CODE_FENCE_RE.sub("", reply).strip('"').strip())
+
+
+class ActionType(str, Enum):
     NONE = "none"
     SPEAK = "speak"
     NON_VERBAL = "non-verbal"
@@ -47,13 +65,19 @@ class ActionType(Enum):
     def __str__(self) -> str:
         return self.value
 
-    def __eq__(self, other: object) -> bool:
-        if isinstance(other, ActionType):
-            return self.value == other.value
-        elif isinstance(other, str):
-            return self.value == other
-        else:
-            return NotImplemented
+
+# AgentAction.to_natural_language phrasing; "{}" is filled with the action's argument.
+_NL_TEMPLATES: dict[ActionType, str] = {
+    ActionType.NONE: "did nothing",
+    ActionType.SPEAK: 'said: "{}"',
+    ActionType.THOUGHT: 'thought: "{}"',
+    ActionType.BROWSE: 'browsed: "{}"',
+    ActionType.RUN: 'ran: "{}"',
+    ActionType.READ: 'read: "{}"',
+    ActionType.WRITE: 'wrote: "{}"',
+    ActionType.NON_VERBAL: "[non-verbal] {}",
+    ActionType.LEAVE: "left the conversation",
+}
 
 
 @DataModelFactory.register("agent_action")
@@ -68,90 +92,41 @@ class AgentAction(DataModel):
     path: Optional[str] = Field(description="path of file")
 
     def to_natural_language(self) -> str:
-        action_descriptions = {
-            ActionType.NONE: "did nothing",
-            ActionType.SPEAK: f'said: "{self.argument}"',
-            ActionType.THOUGHT: f'thought: "{self.argument}"',
-            ActionType.BROWSE: f'browsed: "{self.argument}"',
-            ActionType.RUN: f'ran: "{self.argument}"',
-            ActionType.READ: f'read: "{self.argument}"',
-            ActionType.WRITE: f'wrote: "{self.argument}"',
-            ActionType.NON_VERBAL: f"[{self.action_type.value}] {self.argument}",
-            ActionType.LEAVE: "left the conversation",
-        }
+        template = _NL_TEMPLATES.get(self.action_type, "performed an unknown action")
+        return template.format(self.argument)
 
-        return action_descriptions.get(self.action_type, "performed an unknown action")
 
+_ALL_ACTIONS: list[ActionType] = list(ActionType)
 
-@NodeFactory.register("llm_agent")
-class LLMAgent(BaseAgent[AgentAction | Tick | Text, AgentAction]): # type: ignore[misc]
-    def __init__(
-        self,
-        input_text_channels: list[str],
-        input_tick_channel: str,
-        input_env_channels: list[str],
-        output_channel: str,
-        query_interval: int,
-        agent_name: str,
-        goal: str,
-        model_name: str,
-        redis_url: str,
-    ):
-        super().__init__(
-            [
-                (input_text_channel, AgentAction)
-                for input_text_channel in input_text_channels
-            ]
-            + [
-                (input_tick_channel, Tick),
-            ]
-            + [(input_env_channel, Text) for input_env_channel in input_env_channels],
-            [(output_channel, AgentAction)],
-            redis_url,
-        )
-        self.output_channel = output_channel
-        self.query_interval = query_interval
-        self.count_ticks = 0
-        self.message_history: list[tuple[str, str, str]] = []
-        self.name = agent_name
-        self.model_name = model_name
-        self.goal = goal
+# Parametrise the envelope once instead of on every publish.
+_AgentActionMessage = Message[AgentAction]
 
-    async def send(self, message: AgentAction) -> None:
-        if message.action_type in ("speak", "thought"):
-            await self.r.publish(
-                self.output_channel,
-                Message[AgentAction](data=message).model_dump_json(),
-            )
+# Action types LLMAgent.send publishes to its output channel and to the runtime.
+_PUBLISH_OUTPUT = frozenset({"speak", "thought"})
+_PUBLISH_RUNTIME = frozenset({"browse", "browse_action", "write", "read", "run"})
 
-        elif message.action_type in ("browse", "browse_action", "write", "read", "run"):
-            await self.r.publish(
-                "Agent:Runtime",
-                Message[AgentAction](data=message).model_dump_json(),
-            )
-
-    def _format_message_history(
-        self, message_history: list[tuple[str, str, str]]
-    ) -> str:
-        ## TODO: akhatua Fix the mapping of action to be gramatically correct
-        return "\n".join(
-            (f"{speaker} {action} {message}")
-            for speaker, action, message in message_history
-        )
+# Env channels carrying the agent's scenario, published by InitialMessageNode.
+SCENE_CHANNEL_PREFIX = "Scene:"
+# Oldest history entries are dropped past this many, keeping memory and prompt size bounded.
+MAX_HISTORY_ENTRIES = 200
 
-    def get_action_template(self, selected_actions: list[ActionType]) -> str:
-        """
-        Returns the action template string with selected actions.
+# Which reply arguments feed AgentAction.argument and AgentAction.path for each
+# action. The history entry records the argument, or the path when there is none.
+_ACTION_ARG_KEYS: dict[str, tuple[Optional[str], Optional[str]]] = {
+    "thought": ("content", None),
+    "speak": ("content", None),
+    "non-verbal": ("content", None),
+    "browse": ("url", None),
+    "browse_action": ("command", None),
+    "run": ("command", None),
+    "write": ("content", "path"),
+    "read": (None, "path"),
+    "none": (None, None),
+    "leave": (None, None),
+}
 
-        Args:
-            selected_actions (list[ActionType]): List of ActionType enum members to include in the template.
 
-        Returns:
-            str: The action template with the selected actions.
-        """
-        base_template = """ You are talking to another agent.
-        You are {agent_name}.\n
-        {message_history}\nand you plan to {goal}.
+_ACTION_TEMPLATE_BASE = """ You are talking to another agent.
         ## Action
         What is your next thought or action? Your response must be in JSON format.
 
@@ -160,27 +135,21 @@ class LLMAgent(BaseAgent[AgentAction | Tick | Text, AgentAction]): # type: ignor
         * `args`, which is a map of key-value pairs, specifying the arguments for that action
         """
 
-        action_descriptions = {
-            str(
-                ActionType.SPEAK
-            ): """`speak` - you can talk to the other agents to share information or ask them something. Arguments:
-                * `content` - the message to send to the other agents (should be short)""",
-            str(
-                ActionType.THOUGHT
-            ): """`thought` - only use this rarely to make a plan, set a goal, record your thoughts. Arguments:
-                * `content` - the message you send yourself to organize your thoughts (should be short). You cannot think more than 2 turns.""",
-            str(
-                ActionType.NONE
-            ): """`none` - you can choose not to take an action if you are waiting for some data""",
-            str(
-                ActionType.NON_VERBAL
-            ): """`non-verbal` - you can choose to do a non verbal action
-                * `content` - the non veral action you want to send to other agents. eg: smile, shrug, thumbs up""",
-            str(ActionType.BROWSE): """`browse` - opens a web page. Arguments:
-                * `url` - the URL to open, when you browse the web you must use `none` action until you get some information back. When you get the information back you must summarize the article and explain the article to the other agents.""",
-            str(
-                ActionType.BROWSE_ACTION
-            ): """`browse_action` - actions you can take on a web browser
+_DESC_SPEAK = """`speak` - you can talk to the other agents to share information or ask them something. Arguments:
+                * `content` - the message to send to the other agents (should be short)"""
+
+_DESC_THOUGHT = """`thought` - only use this rarely to make a plan, set a goal, record your thoughts. Arguments:
+                * `content` - the message you send yourself to organize your thoughts (should be short). You cannot think more than 2 turns."""
+
+_DESC_NONE = """`none` - you can choose not to take an action if you are waiting for some data"""
+
+_DESC_NON_VERBAL = """`non-verbal` - you can choose to do a non verbal action
+                * `content` - the non veral action you want to send to other agents. eg: smile, shrug, thumbs up"""
+
+_DESC_BROWSE = """`browse` - opens a web page. Arguments:
+                * `url` - the URL to open, when you browse the web you must use `none` action until you get some information back. When you get the information back you must summarize the article and explain the article to the other agents."""
+
+_DESC_BROWSE_ACTION = """`browse_action` - actions you can take on a web browser
                 * `command` - the command to run. You have 15 available commands. These commands must be a single string value of command
                     Options for `command`:
                         `command` = goto(url: str)
@@ -269,188 +238,268 @@ class LLMAgent(BaseAgent[AgentAction | Tick | Text, AgentAction]): # type: ignor
                             Description: Click an element and wait for a "filechooser" event, then select one or multiple input files for upload. Relative file paths are resolved relative to the current working directory. An empty list clears the selected files.
                             Examples:
                                 upload_file('572', '/home/user/my_receipt.pdf')
-                                upload_file('63', ['/home/bob/Documents/image.jpg', '/home/bob/Documents/file.zip'])""",
-            str(ActionType.READ): """`read` - reads the content of a file. Arguments:
-                * `path` - the path of the file to read""",
-            str(ActionType.WRITE): """`write` - writes the content to a file. Arguments:
-                * `path` - the path of the file to write
-                * `content` - the content to write to the file""",
-            str(
-                ActionType.RUN
-            ): """`run` - runs a command on the command line in a Linux shell. Arguments:
-                * `command` - the command to run""",
-            str(
-                ActionType.LEAVE
-            ): """`leave` - if your goals have been completed or abandoned, and you're absolutely certain that you've completed your task and have tested your work, use the leave action to stop working.""",
-        }
+                                upload_file('63', ['/home/bob/Documents/image.jpg', '/home/bob/Documents/file.zip'])"""
 
-        selected_action_descriptions = "\n\n".join(
-            f"[{i+1}] {action_descriptions[str(action)]}"
-            for i, action in enumerate(selected_actions)
-            if str(action) in action_descriptions
-        )
+_DESC_READ = """`read` - reads the content of a file. Arguments:
+                * `path` - the path of the file to read"""
 
-        return (
-            base_template
-            + selected_action_descriptions
-            + """
+_DESC_WRITE = """`write` - writes the content to a file. Arguments:
+                * `path` - the path of the file to write
+                * `content` - the content to write to the file"""
+
+_DESC_RUN = """`run` - runs a command on the command line in a Linux shell. Arguments:
+                * `command` - the command to run"""
+
+_DESC_LEAVE = """`leave` - if your goals have been completed or abandoned, and you're absolutely certain that you've completed your task and have tested your work, use the leave action to stop working."""
+
+_ACTION_DESCRIPTIONS: dict[ActionType, str] = {
+    ActionType.SPEAK: _DESC_SPEAK,
+    ActionType.THOUGHT: _DESC_THOUGHT,
+    ActionType.NONE: _DESC_NONE,
+    ActionType.NON_VERBAL: _DESC_NON_VERBAL,
+    ActionType.BROWSE: _DESC_BROWSE,
+    ActionType.BROWSE_ACTION: _DESC_BROWSE_ACTION,
+    ActionType.READ: _DESC_READ,
+    ActionType.WRITE: _DESC_WRITE,
+    ActionType.RUN: _DESC_RUN,
+    ActionType.LEAVE: _DESC_LEAVE,
+}
+
+_ACTION_TEMPLATE_TRAILER = """
                 You must prioritize actions that move you closer to your goal. Communicate briefly when necessary and focus on executing tasks effectively. Always consider the next actionable step to avoid unnecessary delays.
                 Again, you must reply with JSON, and only with JSON.
             """
+
+# Everything above is identical across ticks and agents; the per-call values go
+# last so providers with prefix caching can reuse the static part of the prompt.
+_ACTION_TEMPLATE_CONTEXT = """
+        You are {agent_name}.\n
+        {message_history}\nand you plan to {goal}.
+        """
+
+
+@functools.lru_cache(maxsize=32)
+def _render_action_template(actions: tuple[ActionType, ...]) -> str:
+    """Assemble the action prompt for one selection of actions.
+
+    Only the action list varies between calls, so the joined string is cached
+    per selection instead of being rebuilt on every tick.
+    """
+    selected_action_descriptions = "\n\n".join(
+        f"[{i+1}] {_ACTION_DESCRIPTIONS[action]}"
+        for i, action in enumerate(actions)
+        if action in _ACTION_DESCRIPTIONS
+    )
+    return (
+        _ACTION_TEMPLATE_BASE
+        + selected_action_descriptions
+        + _ACTION_TEMPLATE_TRAILER
+        + _ACTION_TEMPLATE_CONTEXT
+    )
+
+
+@NodeFactory.register("llm_agent")
+class LLMAgent(BaseAgent[AgentAction | Tick | Text, AgentAction]): # type: ignore[misc]
+    def __init__(
+        self,
+        input_text_channels: list[str],
+        input_tick_channel: str,
+        input_env_channels: list[str],
+        output_channel: str,
+        query_interval: int,
+        agent_name: str,
+        goal: str,
+        model_name: str,
+        redis_url: str,
+        history_window_tokens: int | None = None,
+    ):
+        super().__init__(
+            [
+                (input_text_channel, AgentAction)
+                for input_text_channel in input_text_channels
+            ]
+            + [
+                (input_tick_channel, Tick),
+            ]
+            + [(input_env_channel, Text) for input_env_channel in input_env_channels],
+            [(output_channel, AgentAction)],
+            redis_url,
+        )
+        self.output_channel = output_channel
+        self.query_interval = query_interval
+        self.count_ticks = 0
+        self.message_history: deque[tuple[str, str, str]] = deque(
+            maxlen=MAX_HISTORY_ENTRIES
+        )
+        self._history_buf: deque[str] = deque(maxlen=MAX_HISTORY_ENTRIES)
+        # The scenario from the Scene: channel is kept out of the deques and the
+        # token window so it is never evicted from the prompt.
+        self._scene_setup: str | None = None
+        self._history_str: str | None = None
+        self.history_window_tokens = history_window_tokens
+        self.name = agent_name
+        self.model_name = model_name
+        self.goal = goal
+        # The agent always offers every action, so the template never changes.
+        self._prompt_template = self.get_action_template(_ALL_ACTIONS)
+        self._handlers: dict[type, Callable[[Any], Awaitable[AgentAction]]] = {
+            Text: self._handle_text,
+            Tick: self._handle_tick,
+            AgentAction: self._handle_action,
+        }
+        # Shared reply for every tick and message that does not trigger an action.
+        self._noop = AgentAction(
+            agent_name=agent_name, action_type="none", argument="", path=""
         )
 
+    async def send(self, message: AgentAction) -> None:
+        if message.action_type.value in _PUBLISH_OUTPUT:
+            await self.queue_publish(
+                self.output_channel,
+                _AgentActionMessage(data=message).model_dump_json(),
+            )
+
+        elif message.action_type.value in _PUBLISH_RUNTIME:
+            await self.queue_publish(
+                "Agent:Runtime",
+                _AgentActionMessage(data=message).model_dump_json(),
+            )
+
+    def _append_history(self, speaker: str, action: str, message: str) -> None:
+        self.message_history.append((speaker, action, message))
+        ## TODO: akhatua Fix the mapping of action to be gramatically correct
+        self._history_buf.append(f"{speaker} {action} {message}")
+        self._history_str = None
+
+    def _format_message_history(self) -> str:
+        """
+        Join the history lines, or only the most recent ones that fit in history_window_tokens when it is set.
+        The scene setup always comes first and does not count against the window.
+
+        Tokens are estimated as a quarter of the characters; the newest line is always kept.
+        The result is reused until the next history append.
+        """
+        if self._history_str is not None:
+            return self._history_str
+        if self.history_window_tokens is None:
+            kept = list(self._history_buf)
+        else:
+            kept = []
+            budget = self.history_window_tokens
+            for line in reversed(self._history_buf):
+                budget -= len(line) // 4
+                if budget < 0 and kept:
+                    break
+                kept.append(line)
+            kept.reverse()
+        if self._scene_setup is not None:
+            kept.insert(0, self._scene_setup)
+        self._history_str = "\n".join(kept)
+        return self._history_str
+
+    def get_action_template(self, selected_actions: list[ActionType]) -> str:
+        """
+        Returns the action template string with selected actions.
+
+        Args:
+            selected_actions (list[ActionType]): List of ActionType enum members to include in the template.
+
+        Returns:
+            str: The action template with the selected actions.
+        """
+        return _render_action_template(tuple(selected_actions))
+
     async def aact(self, message: AgentAction | Tick | Text) -> AgentAction:
-        match message:
-            case Text(text=text):
-                if "BrowserOutputObservation" in text:
-                    self.message_history.append(
-                        (
-                            self.name,
-                            "observation data",
-                            "BrowserOutputObservation received.",
-                        )
-                    )
-                    text = text.split("BrowserOutputObservation", 1)[1][:100]
-                self.message_history.append((self.name, "observation data", text))
-                return AgentAction(
-                    agent_name=self.name, action_type="none", argument="", path=""
+        handler = self._handlers.get(type(message))
+        if handler is None:
+            raise ValueError(f"Unexpected message type: {type(message)}")
+        return await handler(message)
+
+    async def event_handler(
+        self, channel: str, message: Message[AgentAction | Tick | Text]
+    ) -> AsyncIterator[tuple[str, Message[AgentAction]]]:
+        # The scenario from InitialMessageNode is pinned by its channel, not by arrival
+        # order, so a runtime observation that happens to come first is never pinned.
+        if (
+            self._scene_setup is None
+            and channel.startswith(SCENE_CHANNEL_PREFIX)
+            and isinstance(message.data, Text)
+        ):
+            self._scene_setup = f"{self.name} observation data {message.data.text}"
+            self._history_str = None
+            return
+        async for output in super().event_handler(channel, message):
+            yield output
+
+    async def _handle_text(self, message: Text) -> AgentAction:
+        text = message.text
+        if "BrowserOutputObservation" in text:
+            self._append_history(
+                self.name,
+                "observation data",
+                "BrowserOutputObservation received.",
+            )
+            text = text.split("BrowserOutputObservation", 1)[1][:100]
+        self._append_history(self.name, "observation data", text)
+        return self._noop
+
+    async def _handle_tick(self, message: Tick) -> AgentAction:
+        self.count_ticks += 1
+        if self.count_ticks % self.query_interval == 0:
+            agent_action: str | None = None
+            try:
+                template = self._prompt_template
+
+                agent_action = await agenerate(
+                    model_name=self.model_name,
+                    template=template,
+                    input_values={
+                        "message_history": self._format_message_history(),
+                        "goal": self.goal,
+                        "agent_name": self.name,
+                    },
+                    temperature=0.7,
+                    output_parser=StrOutputParser(),
                 )
-            case Tick():
-                self.count_ticks += 1
-                if self.count_ticks % self.query_interval == 0:
-                    try:
-                        template = self.get_action_template(
-                            [action for action in ActionType]
-                        )
-
-                        agent_action = await agenerate(
-                            model_name=self.model_name,
-                            template=template,
-                            input_values={
-                                "message_history": self._format_message_history(
-                                    self.message_history
-                                ),
-                                "goal": self.goal,
-                                "agent_name": self.name,
-                            },
-                            temperature=0.7,
-                            output_parser=StrOutputParser(),
+            except Exception as e:
+                print(f"Error during agenerate: {e}")
+            if agent_action is None:
+                return self._noop
+
+            try:
+                data = _load_agent_reply(agent_action)
+                action = data["action"]
+                if action in _ACTION_ARG_KEYS:
+                    argument_key, path_key = _ACTION_ARG_KEYS[action]
+                    args = data.get("args", {})
+                    path = args[path_key] if path_key else ""
+                    if argument_key:
+                        argument = args[argument_key]
+                    else:
+                        argument = "Nan" if action == "read" else ""
+                    if action != "none":
+                        self._append_history(
+                            self.name, action, argument if argument_key else path
                         )
-                    except Exception as e:
-                        print(f"Error during agenerate: {e}")
-
-                    agent_action = (
-                        agent_action.replace("```", "")
-                        .replace("json", "")
-                        .strip('"')
-                        .strip()
-                    )
-
-                    try:
-                        data = json.loads(agent_action)
-                        action = data["action"]
-                        if action == "thought":
-                            content = data["args"]["content"]
-                            self.message_history.append((self.name, action, content))
-                            return AgentAction(
-                                agent_name=self.name,
-                                action_type="thought",
-                                argument=content,
-                                path="",
-                            )
-
-                        elif action == "speak":
-                            content = data["args"]["content"]
-                            self.message_history.append((self.name, action, content))
-                            return AgentAction(
-                                agent_name=self.name,
-                                action_type=action,
-                                argument=content,
-                                path="",
-                            )
-
-                        elif action == "non-verbal":
-                            content = data["args"]["content"]
-                            self.message_history.append((self.name, action, content))
-                            return AgentAction(
-                                agent_name=self.name,
-                                action_type=action,
-                                argument=content,
-                                path="",
-                            )
-
-                        elif action == "browse":
-                            url = data["args"]["url"]
-                            self.message_history.append((self.name, action, url))
-                            return AgentAction(
-                                agent_name=self.name,
-                                action_type=action,
-                                argument=url,
-                                path="",
-                            )
-
-                        elif action == "browse_action":
-                            command = data["args"]["command"]
-                            self.message_history.append((self.name, action, command))
-                            return AgentAction(
-                                agent_name=self.name,
-                                action_type=action,
-                                argument=command,
-                                path="",
-                            )
-
-                        elif action == "run":
-                            command = data["args"]["command"]
-                            self.message_history.append((self.name, action, command))
-                            return AgentAction(
-                                agent_name=self.name,
-                                action_type=action,
-                                argument=command,
-                                path="",
-                            )
-
-                        elif action == "write":
-                            path = data["args"]["path"]
-                            content = data["args"]["content"]
-                            self.message_history.append((self.name, action, content))
-                            return AgentAction(
-                                agent_name=self.name,
-                                action_type=action,
-                                argument=content,
-                                path=path,
-                            )
-
-                        elif action == "read":
-                            path = data["args"]["path"]
-                            self.message_history.append((self.name, action, path))
-                            return AgentAction(
-                                agent_name=self.name,
-                                action_type=action,
-                                argument="Nan",
-                                path=path,
-                            )
-
-                        elif action == "none":
-                            return AgentAction(
-                                agent_name=self.name,
-                                action_type="none",
-                                argument="",
-                                path="",
-                            )
-                        else:
-                            print(f"Unknown action: {action}")
-                    except json.JSONDecodeError as e:
-                        print(f"Error decoding JSON: {e}")
-                else:
+                    if action == "leave":
+                        # the agent is done; stop scheduling further observations
+                        self.shutdown_event.set()
                     return AgentAction(
-                        agent_name=self.name, action_type="none", argument="", path=""
+                        agent_name=self.name,
+                        action_type=action,
+                        argument=argument,
+                        path=path,
                     )
-            case AgentAction(
-                agent_name=agent_name, action_type=action_type, argument=text
-            ):
-                if action_type == "speak":
-                    self.message_history.append((agent_name, str(action_type), text))
-                return AgentAction(
-                    agent_name=self.name, action_type="none", argument="", path=""
-                )
-        raise ValueError(f"Unexpected message type: {type(message)}")
\ No newline at end of file
+                else:
+                    print(f"Unknown action: {action}")
+            except json.JSONDecodeError as e:
+                print(f"Error decoding JSON: {e}")
+        # not a query tick, or the reply could not be turned into an action
+        return self._noop
+
+    async def _handle_action(self, message: AgentAction) -> AgentAction:
+        if message.action_type == "speak":
+            self._append_history(
+                message.agent_name, str(message.action_type), message.argument
+            )
+        return self._noop
@@ -29,13 +29,16 @@ class InitialMessageNode(Node[DataModel, Text]):
         )
         self.env_scenario = env_scenario
         self.output_channels = output_channels
+        # The scenario never changes, so serialize it once up front.
+        self.env_scenario_message = Message[Text](
+            data=Text(text=env_scenario)
+        ).model_dump_json()
 
     async def send_env_scenario(self) -> None:
-        for output_channel in self.output_channels:
-            await self.r.publish(
-                output_channel,
-                Message[Text](data=Text(text=self.env_scenario)).model_dump_json(),
-            )
+        async with self.r.pipeline(transaction=False) as pipe:
+            for output_channel in self.output_channels:
+                pipe.publish(output_channel, self.env_scenario_message)
+            await pipe.execute()
 
     async def event_loop(self) -> None:
         await self.send_env_scenario()